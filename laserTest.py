@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 ################################################################################
 #
 # Tool to generate laser cutter tests
@@ -53,12 +53,28 @@
 
 #### TODO make option to add comments (in "()" chars) to GCode lines
 
+from __future__ import print_function
+
 import argparse
 import datetime
+import itertools
 import os
+import re
 import sys
 
 
+# GCode line templates (GCodes are ASCII, so they're kept as bytes)
+_LASER_ON = b"M03 S%g"
+_LASER_OFF = b"M05"
+_CUT = b"G01 X%.4f Y%.4f F%g"
+_CUT_INLINE = b"G01 X%.4f Y%.4f S%g F%g"
+_RAPID = b"G00 X%.4f Y%.4f Z%.4f"
+_RAPID_XY = b"G00 X%.4f Y%.4f"
+
+# Test dimension input string: <min>:<max>,<cnt>
+_DIM_RE = re.compile(r'^([^:]+):([^,]+),(.+)$')
+
+
 def makeInputStr(minVal, maxVal, count):
     """
     Create a default input string for a given test dimension.
@@ -75,26 +91,40 @@ class GcodeOutput(object):
     # Supported output modes
     OUTPUT_MODES = ('FILE', 'GRBL')
 
-    def __init__(self, mode, file_):
+    # Size (in bytes) of the write buffer used for file output
+    WRITE_BUF_SIZE = 1 << 16
+
+    def __init__(self, mode, file_, streaming=False, verbosity=0,
+                 comment=False):
         """
         Take the output mode (currently, you can emit to a file/stdout or
          drive the Arduino-based GRBL controller), and the name of the file
          to write to (for file mode) or the port to which the GRBL controller
          is attached and instantiate an output object that can be used to
          batch up output and then emit it
+        GCodes are given as (ASCII) bytes and written to the binary output.
+        If 'streaming' is set (FILE mode only), composed GCodes are written
+         straight through the (buffered) output instead of being held until
+         emit() -- this means there's nothing for postProcess() to work on.
+        The 'verbosity' level controls logging, and 'comment' whether the
+         header block is added (as GCode comments) to the output.
         """
         self.gcodes = []
+        self.verbosity = verbosity
+        self.comment = comment
         mode = mode.upper()
         if mode not in GcodeOutput.OUTPUT_MODES:
             raise ValueError("Invalid output mode {0}, must be one of {1}".
                              format(mode, GcodeOutput.OUTPUT_MODES))
         self.mode = mode
+        self.streaming = streaming and self.mode == 'FILE'
         if self.mode == 'FILE':
             if file_ == '-':
-                self.output = sys.stdout
+                self.output = getattr(sys.stdout, 'buffer', sys.stdout)
             else:
                 try:
-                    self.output = open(file_, 'w')
+                    self.output = open(file_, 'wb',
+                                       GcodeOutput.WRITE_BUF_SIZE)
                 except Exception as ex:
                     raise ValueError("Unable to write output to {0}; {1}".
                                      format(file_, ex))
@@ -109,9 +139,9 @@ class GcodeOutput(object):
         Add the given string to the header block that is to be emitted at the
          start of the output in FILE mode.
         """
-        if verbosity > 0:
+        if self.verbosity > 0:
             sys.stderr.write("{0}\n".format(str_))
-        if comment and self.mode == 'FILE':
+        if self.comment and self.mode == 'FILE':
             if not self.header:
                 raise RuntimeError("Cannot add to headers after first emit")
             self.header += "( {0} )\n".format(str_)
@@ -119,11 +149,18 @@ class GcodeOutput(object):
     def compose(self, gcodes):
         """
         Build up the GCodes to be (optionally post-processed) and emmited later
+        Takes any iterable of GCode lines (e.g., a list, tuple, or generator).
         """
         #### TODO see if there are checks or modifications needed on compose
-        if verbosity > 1:
-            print gcodes
-        self.gcodes += gcodes
+        if self.verbosity > 1:
+            gcodes = list(gcodes)
+            print([gcode.decode('ascii') for gcode in gcodes])
+            sys.stdout.flush()
+        if self.streaming:
+            self._writeHeader()
+            self.output.writelines(gcode + b"\n" for gcode in gcodes)
+        else:
+            self.gcodes.extend(gcodes)
 
     def getLen(self):
         """
@@ -145,15 +182,25 @@ class GcodeOutput(object):
          leave the buffer empty.
         """
         if self.mode == 'FILE':
-            if self.header:
-                self.output.write(self.header)
-                self.header = None
-            outStr = "\n".join(self.gcodes)
-            self.output.write(outStr)
+            self._writeHeader()
+            if self.gcodes:
+                self.output.write(b"\n".join(self.gcodes) + b"\n")
+            self.output.flush()
         elif self.mode == 'GRBL':
             pass    #### FIXME
         self.gcodes = []
 
+    def _writeHeader(self):
+        """
+        Write out the header block (in FILE mode), if it hasn't been already.
+        The header is encoded to ASCII once, here, as it's written.
+        """
+        if self.header:
+            # (keep anything already printed to stdout ahead of the output)
+            sys.stdout.flush()
+            self.output.write(self.header.encode('ascii', 'replace'))
+            self.header = None
+
 
 class InputArgumentError(ValueError):
     """
@@ -170,17 +217,23 @@ class Dimension(object):
      that holds the validated state of that input.
     Throws ValueError if bad input given.
     """
+    __slots__ = ('name', 'val', 'minVal', 'maxVal', 'count', 'incr', 'fixed',
+                 'indx', '_values')
+
     def __init__(self, inputStr):
         self.name = "UNINITIALIZED"
         self.val = None
-        try:
-            rangeStr, countStr = inputStr.split(',')
-            minStr, maxStr = rangeStr.split(":")
-            self.minVal = float(minStr)
-            self.maxVal = float(maxStr)
-            self.count = int(countStr)
-        except Exception:
-            raise
+        self._values = None
+        m = _DIM_RE.match(inputStr)
+        if m is None:
+            raise InputArgumentError("Invalid test dimension {0}, must be "
+                                     "<min>:<max>,<cnt>".format(inputStr))
+        self.minVal = float(m.group(1))
+        self.maxVal = float(m.group(2))
+        self.count = int(m.group(3))
+        if self.count < 1:
+            raise InputArgumentError("Invalid count in test dimension {0}, "
+                                     "must be at least 1".format(inputStr))
         if ((self.minVal == self.maxVal and self.count != 1) or
                 (self.minVal != self.maxVal and self.count == 1)):
             sys.stderr.write("Warning: inconsistent fixed spec {0}\n".
@@ -207,18 +260,33 @@ class Dimension(object):
         Throws exception if ask for more values after having reached the max.
         (The caller should be looping on the count and not relying on this
         for loop termination conditions.)
-        Compute next val based on count (as opposed to adding 'incr') to avoid
-         accumulating errors.
+        The values are looked up in the (precomputed) table from values().
         """
         if self.fixed:
             return self.minVal
         self.indx += 1
         if self.indx >= self.count:
             raise ValueError("Asked for too many next values")
-        self.val = round(((self.indx * ((self.maxVal - self.minVal) /
-                                        (self.count - 1))) + self.minVal), 2)
+        self.val = self.values()[self.indx]
         return self.val
 
+    def values(self):
+        """
+        Return a tuple of all the values in the range (i.e., minVal followed by
+         what successive calls to next() would return), computed on first use.
+        Returns 'count' copies of minVal if the dimension is fixed.
+        Compute each val based on count (as opposed to adding 'incr') to avoid
+         accumulating errors.
+        """
+        if self._values is None:
+            if self.fixed:
+                self._values = (self.minVal,) * self.count
+            else:
+                self._values = (self.minVal,) + \
+                    tuple(round(((i * self.incr) + self.minVal), 2)
+                          for i in range(1, self.count))
+        return self._values
+
     def __str__(self):
         incr = "%.1f" % round(self.incr, 1)
         return "{0}: \tmin = {1}, \tmax = {2}, \tcount = {3}, \tincr = {4}, \t{5}". \
@@ -234,12 +302,11 @@ class SpeedDim(Dimension):
     Encapsulates the Speed test dimension.
     This defines the speed (in mm/min) that the laser moves during cuts.
     """
+    __slots__ = ()
+
     def __init__(self, speedStr):
         self.name = "Speed"
-        try:
-            super(self.__class__, self).__init__(speedStr)
-        except Exception:
-            raise
+        super(self.__class__, self).__init__(speedStr)
         if self.minVal < TestParams.MIN_XY_SPEED:
             raise InputArgumentError("Minimum speed to slow (< {0})".
                                      format(TestParams.MIN_XY_SPEED))
@@ -256,12 +323,11 @@ class PowerDim(Dimension):
      ranges from 0 (i.e., off) to 10000 (i.e., max power) -- this is
      all defined in the GRBL source code constants.
     """
+    __slots__ = ()
+
     def __init__(self, powerStr):
         self.name = "Power"
-        try:
-            super(self.__class__, self).__init__(powerStr)
-        except Exception:
-            raise
+        super(self.__class__, self).__init__(powerStr)
         if self.minVal < TestParams.MIN_POWER:
             raise InputArgumentError("Minimum power too low (< {0})".
                                      format(TestParams.MIN_POWER))
@@ -275,12 +341,11 @@ class DistanceDim(Dimension):
     Encapsulates the Distance test dimension.
     This is the Z-axis distance from the cutting surface (aka: focus).
     """
+    __slots__ = ()
+
     def __init__(self, distanceStr):
         self.name = "Distance"
-        try:
-            super(self.__class__, self).__init__(distanceStr)
-        except Exception:
-            raise
+        super(self.__class__, self).__init__(distanceStr)
         if self.minVal < TestParams.MIN_Z_DISTANCE:
             raise InputArgumentError("Minimum distance too close (< {0})".
                                      format(TestParams.MIN_Z_DISTANCE))
@@ -294,6 +359,8 @@ class Shapeoko2(object):
     Encapsulates the specifics of a particular CNC machine.
     This is the Shapeoko2 with Acme Z axis and the J-Tech 3.8W Laser Diode.
     """
+    __slots__ = ()
+
     # X-/Y-axis cutting speed constants (in mm/min)
     DEF_XY_SPEED = 750.0
     MIN_XY_SPEED = 100.0
@@ -346,46 +413,43 @@ class TestParams(Shapeoko2):
     DEF_POWER_COUNT = 1
     DEF_DISTANCE_COUNT = 1
 
+    __slots__ = ('speed', 'power', 'distance', 'lineHeight', 'dims', 'varDims',
+                 'numFixedDims', 'numVarDims', 'numRows', 'numCols', 'xDim',
+                 'yDim', 'xIncr', 'yIncr', 'width', 'height')
+
     def __init__(self, speedTuple, powerTuple, distanceTuple,
                  lineHeight=DEF_LINE_HEIGHT):
-        try:
-            self.speed = SpeedDim(speedTuple)
-            self.power = PowerDim(powerTuple)
-            self.distance = DistanceDim(distanceTuple)
-        except Exception:
-            raise
+        self.speed = SpeedDim(speedTuple)
+        self.power = PowerDim(powerTuple)
+        self.distance = DistanceDim(distanceTuple)
         self.lineHeight = lineHeight
         self.dims = [self.speed, self.power, self.distance]
         numDims = len(self.dims)
-        self.varDims = [dim for dim in self.dims if not dim.fixed]
-        self.numFixedDims = sum([self.speed.fixed, self.power.fixed,
-                                 self.distance.fixed])
-        self.numVarDims = numDims - self.numFixedDims
+
+        # variable dims first, in order of decreasing count
+        ordered = sorted(self.dims, key=lambda dim: (dim.fixed, -dim.count))
+        self.numVarDims = sum(1 for dim in self.dims if not dim.fixed)
+        self.numFixedDims = numDims - self.numVarDims
+        self.varDims = ordered[:self.numVarDims]
 
         if self.numVarDims >= numDims:
             # can't (effectively) plot three variable dimensions on 2D surface
             raise InputArgumentError("Too many free dimensions, at least one must be fixed")
-        elif self.numVarDims < 2:
-            # at most one variable dim, so just one row
-            self.numRows = 1
-            self.yDim = None
-            if self.numVarDims == 1:
-                # only one row along the one variable dim
-                self.xDim = self.varDims[0]
-                self.numCols = self.varDims[0].count
-            else:
-                # no variable dims, so just one test cut
-                self.numCols = 1
-                self.xDim = None
-        else:
-            # max count of all variable dims
-            self.xDim = max(self.varDims, key=lambda item: item.count)
 
-            # not the xDim, but the other variable one
-            self.yDim = [dim for dim in self.varDims if dim != self.xDim][0]
-
-            self.numRows = self.yDim.count
+        # the variable dim with the max count goes on the X axis, the other
+        #  one (if any) on the Y axis
+        self.xDim = ordered[0] if self.numVarDims > 0 else None
+        self.yDim = ordered[1] if self.numVarDims > 1 else None
+        if self.xDim:
             self.numCols = self.xDim.count
+        else:
+            # no variable dims, so just one test cut
+            self.numCols = 1
+        if self.yDim:
+            self.numRows = self.yDim.count
+        else:
+            # at most one variable dim, so just one row
+            self.numRows = 1
 
         # increment to move X for each new column
         if self.numCols <= 1:
@@ -427,13 +491,118 @@ class TestParams(Shapeoko2):
         self.xDim.reset()
         return self.yDim.next()
 
+    def schedule(self, dim):
+        """
+        Return a table (indexed by row number and then column number) of the
+         values that the given dimension takes on for each of the test cuts.
+        """
+        vals = dim.values()
+        if dim is self.xDim:
+            return [vals] * self.numRows
+        if dim is self.yDim:
+            return [(val,) * self.numCols for val in vals]
+        return [(dim.minVal,) * self.numCols] * self.numRows
+
     def __str__(self):
-        s = ""
-        for name, dim in self.dims:
-            s += "{0}: {1}\n".format(name, str(dim))
-        s += "xDim: {0}, numRows: {1}, yDim: {2}, numCols: {3}\n".\
-            format(self.xDim, self.numRows, self.yDim, self.numCols)
-        return s
+        parts = [str(dim) for dim in self.dims]
+        parts.append("xDim: {0}, numRows: {1}, yDim: {2}, numCols: {3}".
+                     format(self.xDim, self.numRows, self.yDim, self.numCols))
+        return "\n".join(parts)
+
+
+def _noop(*args):
+    """
+    Stand-in for a logging function that's been turned off.
+    """
+    pass
+
+
+def _logCutVals(power, speed, distance):
+    """
+    Log the values used for a test cut.
+    """
+    print("Power: {0}, Speed: {1}, Distance: {2}".format(power, speed,
+                                                          distance))
+
+
+def buildProgram(parms, verbosity=0, inlineSpindle=False):
+    """
+    Generate the complete GCode program for the given test parameters and
+     return it as an iterable of GCode lines (to be passed to compose()).
+    Every test cut is preceded by a rapid move to the baseline of that cut
+     (the first one being the move to the starting position), so the program
+     body is built in a single pass over the (row-major) list of test cuts.
+    A trace of the rows and columns is printed if 'verbosity' is above 2.
+    If 'inlineSpindle' is set, each cut is a single G01 that carries its own
+     laser power (S), instead of being bracketed by M03/M05 -- this requires
+     GRBL 1.1+ in laser mode ($32=1), which keeps the laser off during rapid
+     (G00) moves.
+    """
+    powers = parms.schedule(parms.power)
+    speeds = parms.schedule(parms.speed)
+    distances = parms.schedule(parms.distance)
+
+    # (x, y, power, speed, distance) of the baseline of each test cut
+    # (hoist the per-row/column values so the inner loop is just a zip)
+    xIncr = parms.xIncr
+    yIncr = parms.yIncr
+    xs = [colNum * xIncr for colNum in range(parms.numCols)]
+    cuts = [cut
+            for rowNum in range(parms.numRows)
+            for cut in zip(xs, itertools.repeat(rowNum * yIncr),
+                           powers[rowNum], speeds[rowNum], distances[rowNum])]
+
+    if verbosity > 2:
+        # choose the per-cut logging once, rather than testing on every cut
+        logCutVals = (_noop, _logCutVals)[verbosity > 3]
+        for indx, (x, y, p, s, z) in enumerate(cuts):
+            rowNum, colNum = divmod(indx, parms.numCols)
+            if colNum == 0:
+                print("Row: {0}".format(rowNum + 1))
+            print("Column: {0}".format(colNum + 1))
+            logCutVals(p, s, z)
+
+    # generate G-Code preamble
+    # (set coordinates to metric and absolute mode (so errors don't accumulate)
+    # N.B. This assumes that the laser starts at the origin, so no initial moves
+    #  are needed.
+    #### TODO decide if need to go to absolute Z position or if everything is relative to the starting point
+    startX = 0.0
+    startY = 0.0
+    startZ = distances[0][0]
+    preamble = (b"G21",
+                b"G90")
+    if inlineSpindle:
+        # enable the laser at zero power, each cut sets its own power
+        preamble += (_LASER_ON % 0,)
+
+    # generate tests (rows of columns): rapid move to the baseline of the
+    #  cut, turn on laser (at power), cut vertical line, and turn laser off
+    # (each cut has constant Z/distance so leave it where it is)
+    # N.B. Z is only given in the rapid move when it differs from the prior
+    #  cut's (the first move always gives it); Y always changes as the laser
+    #  is left at the top of the previous cut.
+    lineHeight = parms.lineHeight
+    prevZs = itertools.chain((None,), (cut[4] for cut in cuts))
+    rapids = ((_RAPID_XY % (x, y)) if z == prevZ else (_RAPID % (x, y, z))
+              for (x, y, p, s, z), prevZ in zip(cuts, prevZs))
+    if inlineSpindle:
+        tests = (line
+                 for rapid, (x, y, p, s, z) in zip(rapids, cuts)
+                 for line in (rapid,
+                              _CUT_INLINE % (x, y + lineHeight, p, s)))
+    else:
+        tests = (line
+                 for rapid, (x, y, p, s, z) in zip(rapids, cuts)
+                 for line in (rapid, _LASER_ON % p,
+                              _CUT % (x, y + lineHeight, s), _LASER_OFF))
+
+    # rapid move to the origin (turning off the laser first if it was left on)
+    gotoStart = (_RAPID % (startX, startY, startZ),)
+    if inlineSpindle:
+        gotoStart = (_LASER_OFF,) + gotoStart
+
+    return itertools.chain(preamble, tests, gotoStart)
 
 
 # Instantiate the defaults
@@ -452,7 +621,7 @@ defDistance = makeInputStr(TestParams.DEF_Z_DISTANCE,
 if __name__ == '__main__':
     prog = sys.argv[0]
     u1 = "[-v] -s <min:max,cnt> -p <min:max,cnt> -d <min:max,cnt> [-n]"
-    u2 = "[-m <outputMode>] [-o {<outPath>}] [-c]"
+    u2 = "[-m <outputMode>] [-o {<outPath>}] [-c] [-i]"
     usage = prog + u1 + u2
     parser = argparse.ArgumentParser()
     parser.add_argument("-v", "--verbose", action="count", default=0,
@@ -476,12 +645,13 @@ if __name__ == '__main__':
     parser.add_argument("-c", "--comment", action="store_true", default=False,
                         dest="comment",
                         help="add header comments to gcode output")
+    parser.add_argument("-i", "--inline_spindle", action="store_true",
+                        default=False, dest="inlineSpindle",
+                        help="set laser power on each cut's G01 (requires GRBL laser mode, $32=1)")
     args = parser.parse_args()
 
-    verbosity = args.verbosity
-    comment = args.comment
-
-    gcOut = GcodeOutput(args.outMode, args.outPath)
+    gcOut = GcodeOutput(args.outMode, args.outPath, streaming=True,
+                        verbosity=args.verbosity, comment=args.comment)
 
     try:
         parms = TestParams(args.speed, args.power, args.distance)
@@ -524,6 +694,8 @@ if __name__ == '__main__':
         oPath = args.outPath
     gcOut.hdr("    Output:    mode = {0}, path = {1}".format(args.outMode,
                                                              oPath))
+    if args.inlineSpindle:
+        gcOut.hdr("    Inline Spindle:  laser power set on each cut ($32=1)")
 
     if args.dryRun:
         sys.stdout.write("\nDry run: exiting\n")
@@ -536,74 +708,7 @@ if __name__ == '__main__':
     ####      (figure out what the difference is in speed vs. power)
     #### TODO consider drawing legends for each value (x and y axis labels)
 
-    # generate G-Code preamble
-    # (set coordinates to metric and absolute mode (so errors don't accumulate)
-    # N.B. This assumes that the laser starts at the origin, so no initial moves
-    #  are needed.
-    #### TODO decide if need to go to absolute Z position or if everything is relative to the starting point
-    startX = 0.0
-    startY = 0.0
-    startZ = parms.distance.val
-
-    x = startX
-    y = startY
-    z = startZ
-    preamble = ["G21",
-                "G90",
-                "G00 X{0} Y{1} Z{2}".format(x, y, z)]
-    gcOut.compose(preamble)
-
-    # generate tests (rows of columns)
-    rowBase = 0.0
-    for rowNum in xrange(parms.numRows):
-        if verbosity > 2:
-            print "Row: {0}".format(rowNum + 1)
-        rowBase = rowNum * parms.yIncr
-        for colNum in xrange(parms.numCols):
-            if verbosity > 2:
-                print "Column: {0}".format(colNum + 1)
-            # turn on laser (at power), cut vertical line, and turn laser off
-            # (each cut has constant Z/distance so leave it where it is)
-            x = colNum * parms.xIncr
-            y = rowBase + parms.lineHeight
-            p = parms.power.val
-            s = parms.speed.val
-            cutLine = ["M03 S{0}".format(p),
-                       "G01 X{0} Y{1} F{2}".format(x, y, s),
-                       "M05"]
-            gcOut.compose(cutLine)
-
-            if colNum < (parms.numCols - 1):
-                # bump the X dimension value
-                nx = parms.nextX()
-                if verbosity > 3:
-                    print "Next X: {0}".format(nx)
-
-                # rapid move to baseline position for the next line in this row
-                x += parms.xIncr
-                y = rowBase
-                z = parms.distance.val
-                nextPos = ["G00 X{0} Y{1} Z{2}".format(x, y, z)]
-                gcOut.compose(nextPos)
-
-        if rowNum < (parms.numRows - 1):
-            # bump the Y dimension value
-            ny = parms.nextY()
-            if verbosity > 3:
-                print "Next Y: {0}".format(ny)
-
-            # rapid move to the baseline of the first line on the next row
-            rowBase += parms.yIncr
-            x = 0.0
-            y = rowBase
-            z = parms.distance.val
-            nextRow = ["G00 X{0} Y{1} Z{2}".format(x, y, z)]
-            gcOut.compose(nextRow)
-            #### move to (0, M*row base)
-
-    # rapid move to the origin
-    gotoStart = ["G00 X{0} Y{1} Z{2}".format(startX, startY, startZ)]
-    gcOut.compose(gotoStart)
+    gcOut.compose(buildProgram(parms, args.verbosity, args.inlineSpindle))
 
     gcOut.postProcess()
     gcOut.emit()